@@ -2,15 +2,22 @@
 
 import sys
 import os
+import re
 import argparse
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import tempfile
-import Levenshtein
-import shutil
-from zipfile import ZipFile
-from itertools import product
+from rapidfuzz.distance import Levenshtein
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile, ZIP_STORED
+from itertools import combinations
 from pathlib import Path
-from PIL import Image, ImageChops
+from PIL import Image
+import numpy as np
 import requests
 from bs4 import BeautifulSoup
 
@@ -18,7 +25,12 @@ META_FILE = "meta.yml"
 
 COVER_PROVIDER_URI = 'https://www.amazon.fr/s'
 
-IMG_DIFF_THRESHOLD = 0.07
+# shared HTTP session, keeping connections alive across volume covers
+SESSION = requests.Session()
+
+IMG_HASH_THRESHOLD = 4
+
+CBZ_BUFFER_SIZE = 1 << 20
 
 SCAN_COVER = "0000.jpg"
 SCAN_EXTENSIONS = [
@@ -32,47 +44,47 @@ def die(msg):
     print(msg)
     sys.exit(1)
 
-def thumbnail(img):
-    """Summarise an image into a 16 x 16 image."""
-    return img.resize((16, 16))
+def average_hash(img) -> int:
+    """Summarise an image into a 64-bit perceptual hash."""
+    img = img.convert('L').resize((8, 8), Image.Resampling.BILINEAR)
+    pixels = np.asarray(img, dtype=np.uint8)
+    bits = np.packbits(pixels > pixels.mean())
+    return int.from_bytes(bits.tobytes(), 'big')
 
 
-def pixel_difference(img1, img2) -> float:
-    """Find the difference between two images."""
+def _hash_one(path):
+    img = Image.open(path)
+    # let the JPEG decoder downscale to grayscale, the hash only needs 8 x 8
+    img.draft('L', (8, 8))
+    return path, average_hash(img)
 
-    diff = ImageChops.difference(img1, img2)
-    acc = 0
-    width, height = diff.size
-    for w, h in product(range(width), range(height)):
-        r, g, b = diff.getpixel((w, h))
-        acc += (r + g + b) / 3
 
-    average_diff = acc / (width * height)
-    normalised_diff = average_diff / 255
-    return normalised_diff
+def hash_difference(hash1, hash2) -> int:
+    """Find the number of differing bits between two image hashes."""
+    return (hash1 ^ hash2).bit_count()
 
-def cleanup_dedups(path):
-    """Find images in a directory and compare them all."""
+def find_dedups(files, workers=None):
+    """Find duplicated images among files by comparing them all."""
 
-    files = (list())
-    for ext in SCAN_EXTENSIONS:
-        files += list(Path(path).glob(ext))
-    diffs = {}
+    files = [f for f in files if any(Path(f).match(ext) for ext in SCAN_EXTENSIONS)]
 
-    summaries = [(f, thumbnail(Image.open(f))) for f in files]
-    for (f1, sum1), (f2, sum2) in product(summaries, repeat=2):
-        key = tuple(sorted([str(f1), str(f2)]))
-        if f1 == f2 or key in diffs:
-            continue
+    # pages sharing the very same hash are duplicates of each other
+    buckets = defaultdict(list)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for f, h in ex.map(_hash_one, files, chunksize=8):
+            buckets[h].append(f)
+    duplicates = set()
+    for group in buckets.values():
+        if len(group) > 1:
+            duplicates.update(group)
 
-        diff = pixel_difference(sum1, sum2)
-        diffs[key] = diff
+    # near-identical pages are found by comparing distinct hashes only
+    for h1, h2 in combinations(buckets, 2):
+        if hash_difference(h1, h2) <= IMG_HASH_THRESHOLD:
+            duplicates.update(buckets[h1])
+            duplicates.update(buckets[h2])
 
-    print("    + Cleaning up duplicated pages")
-    for key, diff in diffs.items():
-        if diff < IMG_DIFF_THRESHOLD:
-            for k in key:
-                os.remove(k)
+    return duplicates
 
 def download_cover(path, title, volume):
     search_str = '+'.join(title.split()) + '+' + str(volume)
@@ -81,21 +93,88 @@ def download_cover(path, title, volume):
         'User-Agent':'Chrome/137.0.0.0'
     }
 
-    print("    + Downloading volume cover ...")
-    r = requests.get(COVER_PROVIDER_URI, params={'k': search_str}, headers=headers)
-    soup = BeautifulSoup(r.text, 'html.parser')
-    items = soup.find_all('div', role='listitem')
-
-    sp = BeautifulSoup(str(items[0]), 'html.parser')
+    print(f"    + Volume {volume:03}: Downloading cover ...")
+    r = SESSION.get(COVER_PROVIDER_URI, params={'k': search_str}, headers=headers)
+    soup = BeautifulSoup(r.text, 'lxml')
     img = soup.find('img', class_='s-image')
+    if img is None:
+        print(f"    + Volume {volume:03}: No cover found")
+        return None
     srcset = img['srcset']
     src = srcset.split(',')[-1].lstrip().split(' ')[0]
 
-    r = requests.get(src)
+    r = SESSION.get(src)
     if r.ok and r.status_code == 200:
         dst = os.path.join(path, SCAN_COVER)
         with open(dst, mode="wb") as f:
             f.write(r.content)
+        return dst
+    return None
+
+def process_volume(v, title, cover, chapter_index, number_index, hash_workers, args):
+    """Gather a volume chapter pages and cover into its CBZ archive."""
+    vid = v.get('id')
+
+    chapters = v.get('chapters').split('-')
+    if len(chapters) != 2:
+        die(f"Incorrect chapters definition for volume {vid}")
+
+    # retrieve chapters list
+    chapters_range = range(int(chapters[0]), int(chapters[1]) + 1)
+
+    print(f"  - Volume {vid:03}: Processing {len(chapters_range)} chapters")
+    pages = []
+    # walkthrough chapters
+    for c in chapters_range:
+        chapterdir = chapter_index.get(c)
+
+        # fallback on chapter's closest eligible directory
+        if chapterdir is None:
+            sc = str(c)
+            score = 999
+            for cd in number_index.get(c, ()):
+                dist_calc = Levenshtein.distance(sc, cd, score_cutoff=score)
+                if dist_calc < score:
+                    score = dist_calc
+                    chapterdir = cd
+
+        if chapterdir is None:
+            die(f"Volume {vid:03}: Chapter {c} directory not found")
+
+        cdir = os.path.join(args.input, chapterdir)
+        chapterfiles = sorted(e.name for e in os.scandir(cdir) if e.is_file())
+        if len(chapterfiles) == 0:
+            die(f"Volume {vid:03}: Chapter {c} seems to be empty. Missing scanned pages")
+
+        # chapter files are archived straight from their directory
+        print(f"    + Volume {vid:03}: Adding chapter {c} scanned pages")
+        for f in chapterfiles:
+            ifile = os.path.join(cdir, f)
+            oname = f'{c:04}-{f}'
+            pages.append((ifile, oname))
+
+    if cover:
+        pages.append((cover, SCAN_COVER))
+
+    # check for duplicate images (e.g. cover ads)
+    if (args.dedup):
+        print(f"    + Volume {vid:03}: Cleaning up duplicated pages")
+        duplicates = find_dedups([ifile for ifile, _ in pages], hash_workers)
+        pages = [p for p in pages if p[0] not in duplicates]
+
+    # add all page files into CBZ/ZIP archive
+    print(f"  - Volume {vid:03}: Creating CBZ archive file")
+    pages.sort(key=lambda p: p[1])
+
+    cbzfilename = f'{title} - Volume {vid:03}.cbz'
+    cbzfile = os.path.join(args.output, cbzfilename)
+    # scanned pages are already compressed images (PNG included, which is
+    # deflate itself), store them as is: deflating again, even in parallel
+    # or with a SIMD zlib, would only burn CPU for no size gain
+    with open(cbzfile, 'wb', buffering=CBZ_BUFFER_SIZE) as cbz, \
+         ZipFile(cbz, 'w', compression=ZIP_STORED, allowZip64=True) as zip:
+        for ifile, oname in pages:
+            zip.write(ifile, oname)
 
 # main
 if __name__ == "__main__":
@@ -122,84 +201,56 @@ if __name__ == "__main__":
         die(f"Input directory '{args.input}' metadata file does not exists")
 
     with open(meta_file, 'r') as f:
-        meta = yaml.safe_load(f)
+        meta = yaml.load(f, Loader=SafeLoader)
 
     title = meta.get('title')
     volumes = meta.get('volumes')
     print(f"Processing '{title}' with {len(volumes)} volumes ...")
 
-    chapterdirs = [f for f in os.listdir(args.input) if os.path.isdir(os.path.join(args.input, f))]
-    chapterdirs.sort()
-
-    for v in volumes:
-        vid = v.get('id')
-
-        cbzfilename = f'{title} - Volume {vid:03}.cbz'
-        try:
-            if os.stat(os.path.join(args.output, cbzfilename)):
-                if args.force:
-                    os.remove(os.path.join(args.output, cbzfilename))
-                continue
-        except:
-            pass
-
-        chapters = v.get('chapters').split('-')
-        if len(chapters) != 2:
-            die(f"Incorrect chapters definition for volume {vid}")
-
-        # retrieve chapters list
-        chapters_range = range(int(chapters[0]), int(chapters[1]) + 1)
-
-        # create volume temporary directory
-        tmp_dir = tempfile.TemporaryDirectory()
-
-        print(f"  - Processing volume {vid} with {len(chapters_range)} chapters")
-        # walkthrough chapters
-        for c in chapters_range:
-            candidatedirs = [cd for cd in chapterdirs if str(c) in cd]
-
-            # find chapter's eligible directory
-            score = 999
-            chapterdir = None
-            for cd in candidatedirs:
-                dist_calc = Levenshtein.distance(str(c), cd)
-                if dist_calc < score:
-                    score = dist_calc
-                    chapterdir = cd
-
-            cdir = os.path.join(args.input, chapterdir)
-            chapterfiles = [f for f in os.listdir(cdir) if os.path.isfile(os.path.join(cdir, f))]
-            chapterfiles.sort()
-            if len(chapterfiles) == 0:
-                die(f"Chapter {c} seems to be empty. Missing scanned pages")
-
-            # copy chapter files into temporary
-            print(f"    + Copying chapter {c} scanned pages into temporary volume directory")
-            for f in chapterfiles:
-                ifile = os.path.join(cdir, f)
-                oname = f'{c:04}-{f}'
-                ofile = os.path.join(tmp_dir.name, oname)
-                shutil.copyfile(ifile, ofile)
-
-        # download volume cover from Amazon
-        download_cover(tmp_dir.name, title, vid)
-
-        # check for duplicate images (e.g. cover ads)
-        if (args.dedup):
-            cleanup_dedups(tmp_dir.name)
-
-        # add all page files into CBZ/ZIP archive
-        print("  - Creating CBZ archive file")
-        tmpfiles = [os.path.join(tmp_dir.name, f) for f in os.listdir(tmp_dir.name) if os.path.isfile(os.path.join(tmp_dir.name, f))]
-        tmpfiles.sort()
-
-        cbzfilename = f'{title} - Volume {vid:03}.cbz'
-        cbzfile = os.path.join(args.output, cbzfilename)
-        with ZipFile(cbzfile, 'w') as zip:
-            for f in tmpfiles:
-                zip.write(f, os.path.basename(f))
-
-        # cleanup volume temporary directory
-        shutil.rmtree(tmp_dir.name)
-
-sys.exit(0)
+    chapterdirs = sorted(e.name for e in os.scandir(args.input) if e.is_dir())
+
+    # index chapter directories by their chapter number when their name holds
+    # a single one, and by any number they contain for the fallback lookup
+    # (e.g. names with a volume prefix)
+    chapter_pattern = re.compile(r'(\d+)')
+    chapter_index = {}
+    number_index = defaultdict(list)
+    for cd in chapterdirs:
+        numbers = chapter_pattern.findall(cd)
+        if len(numbers) == 1:
+            chapter_index.setdefault(int(numbers[0]), cd)
+        for n in numbers:
+            number_index[int(n)].append(cd)
+
+    # volumes are independent from each other, process them in parallel and
+    # share the remaining cores among their page hashing pools
+    cpus = os.cpu_count() or 2
+    volume_workers = max(1, cpus // 2)
+    hash_workers = max(1, cpus // volume_workers)
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+         ProcessPoolExecutor(max_workers=volume_workers) as ex:
+        futures = []
+        for v in volumes:
+            vid = v.get('id')
+
+            cbzfilename = f'{title} - Volume {vid:03}.cbz'
+            try:
+                if os.stat(os.path.join(args.output, cbzfilename)):
+                    if args.force:
+                        os.remove(os.path.join(args.output, cbzfilename))
+                    continue
+            except:
+                pass
+
+            # download volume cover from Amazon, one volume at a time so the
+            # provider never sees concurrent searches
+            cover_dir = os.path.join(tmp_dir, f'{vid:03}')
+            os.makedirs(cover_dir)
+            cover = download_cover(cover_dir, title, vid)
+
+            futures.append(ex.submit(process_volume, v, title, cover, chapter_index, number_index, hash_workers, args))
+
+        for future in futures:
+            future.result()
+
+    sys.exit(0)